@@ -1,9 +1,16 @@
 import os
 import re
+import functools
+import hashlib
+import itertools
 import sys
 import subprocess
 import asyncio
+import requests
+from collections import OrderedDict
+from typing import Optional
 from urllib.parse import urlparse
+from ollama import AsyncClient, ResponseError
 from crawl4ai import AsyncWebCrawler, BrowserConfig, CrawlerRunConfig
 
 # ──────────── CONFIGURATION ────────────
@@ -13,101 +20,256 @@ URL        = "https://rpstrength.com/"
 OUTPUT_DIR = "out_chunks"
 SUBFOLDER  = None
 MODEL      = "gemma3:1b-it-qat"
+# Local Ollama server (HTTP API)
+OLLAMA_URL = "http://localhost:11434"
 MAX_CHARS  = 2000
-OVERLAP    = 200
+# Max in-flight summarize requests; start the server with matching slots:
+#   OLLAMA_NUM_PARALLEL=8 OLLAMA_MAX_LOADED_MODELS=1 ollama serve
+# (unset, empty or 0 = "auto" on the server all fall back to 8 here)
+OLLAMA_NUM_PARALLEL = max(1, int(os.environ.get("OLLAMA_NUM_PARALLEL") or 8) or 8)
+# Chunks submitted together; ≤ OLLAMA_NUM_PARALLEL so the server batches them
+BATCH_SIZE = OLLAMA_NUM_PARALLEL
+# Summaries are cached on disk across runs; bump PROMPT_VERSION to
+# invalidate them after changing the prompt or generation options
+CACHE_DIR      = os.path.join(".cache", "summaries")
+PROMPT_VERSION = 3
 # ───────────────────────────────────────
 
+# Instruction first, chunk last and nothing per-call: every prompt shares
+# one prefix whose KV cache Ollama can reuse across chunks
+PROMPT_TMPL = (
+    "Please provide a 2–4 sentence summary of the following text:\n\n"
+    "{}\n\nSummary:"
+)
+
+# Generation options, identical on every call: a change would force Ollama
+# to reload the model and drop its cached prefix. num_keep is left to
+# the server, since the instruction's token count depends on the model.
+OLLAMA_OPTIONS = {
+    "num_ctx": 4096,
+    # 2–4 sentences fit well under 180 tokens; cap decode time
+    "num_predict": 180,
+    # stop at the first run of blank lines instead of rambling on, and
+    # stay close to the text so reruns give the same summary
+    "stop": ["\n\n\n"],
+    "temperature": 0.2,
+}
+# Keep the model (and its KV cache) loaded between batches
+OLLAMA_KEEP_ALIVE = "30m"
+
+# H1/H2 lines that start a new section; compiled once at import
+HEADER_PAT = re.compile(r'(?m)^(?:# |## ).+$')
+
+# crawler settings, built once at import
+BROWSER_CFG = BrowserConfig(headless=True)
+CRAWL_CFG   = CrawlerRunConfig()
+
+# one client (and HTTP connection pool) for every /api/generate call
+_client = AsyncClient(host=OLLAMA_URL)
+
+@functools.lru_cache(maxsize=None)
 def ensure_model(model: str):
     """
-    Ensure `model` is pulled locally. Uses `ollama list` and `ollama pull`.
+    Ensure `model` is pulled locally. Checks Ollama's /api/tags (cached
+    per model for the run) and falls back to `ollama pull`.
     """
-    # list existing models
-    lst = subprocess.run(
-        ["ollama", "list", "models"],
-        capture_output=True, text=True
-    )
-    if lst.returncode != 0:
-        print("❗️ failed to run `ollama list models` – is Ollama installed?")
+    try:
+        resp = requests.get(f"{OLLAMA_URL}/api/tags", timeout=10)
+        resp.raise_for_status()
+    except requests.RequestException:
+        print(f"❗️ failed to reach Ollama at {OLLAMA_URL} – is `ollama serve` running?")
         sys.exit(1)
-    if model not in lst.stdout:
+    names = {m["name"] for m in resp.json().get("models", [])}
+    if model not in names and f"{model}:latest" not in names:
         print(f"⬇️ Pulling model {model}…")
         pull = subprocess.run(["ollama", "pull", model])
         if pull.returncode != 0:
             print(f"❗️ failed to pull {model}")
             sys.exit(1)
 
-def summarize_chunk(chunk: str, model: str) -> str:
-    """
-    Uses `ollama run <model>` with the prompt piped via stdin,
-    decoding I/O as UTF-8 with replacement to avoid CP1252 errors.
-    """
-    prompt = (
-        "Please provide a 2–4 sentence summary of the following text:\n\n"
-        f"{chunk}\n\nSummary:"
-    )
-    # start the process
-    proc = subprocess.Popen(
-        ["ollama", "run", model],
-        stdin=subprocess.PIPE,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE
-    )
-    # send the prompt as UTF-8 bytes
-    out_bytes, err_bytes = proc.communicate(prompt.encode("utf-8"))
-    # decode with replacement
-    out = out_bytes.decode("utf-8", errors="replace")
-    err = err_bytes.decode("utf-8", errors="replace")
-
-    if proc.returncode != 0:
-        if "could not connect to ollama app" in err:
-            print()
-            print("❗️  Could not connect to the Ollama daemon.")
-            print("   • Make sure you have Ollama installed and running:")
-            print("       ollama serve")
-            print()
-            sys.exit(1)
-        raise RuntimeError(f"Ollama error: {err.strip()}")
-
-    return out.strip()
-
-async def fetch_markdown(url: str) -> str:
-    browser_cfg = BrowserConfig(headless=True)
-    crawl_cfg   = CrawlerRunConfig()
-    async with AsyncWebCrawler(config=browser_cfg) as crawler:
-        res = await crawler.arun(url=url, config=crawl_cfg)
-        if not res.success:
-            raise RuntimeError(f"Failed to crawl {url}: {res.error_message}")
-        return res.markdown
+async def generate_summary(prompt: str, model: str) -> str:
+    """
+    Run `prompt` through Ollama's HTTP API (/api/generate).
+    """
+    try:
+        r = await _client.generate(
+            model=model,
+            prompt=prompt,
+            stream=False,
+            options=OLLAMA_OPTIONS,
+            keep_alive=OLLAMA_KEEP_ALIVE,
+        )
+    except ConnectionError:
+        print()
+        print("❗️  Could not connect to the Ollama daemon.")
+        print("   • Make sure you have Ollama installed and running:")
+        print("       ollama serve")
+        print()
+        sys.exit(1)
+    except ResponseError as e:
+        raise RuntimeError(f"Ollama error: {e.error}")
+
+    return r["response"].strip()
+
+def summary_key(prompt: str, model: str) -> str:
+    """
+    Short content hash of a model/prompt pair. BLAKE2b is faster than
+    SHA-256 and collision resistance is all we need here.
+    """
+    return hashlib.blake2b(
+        f"{model}\0{PROMPT_VERSION}\0{prompt}".encode("utf-8"),
+        digest_size=16
+    ).hexdigest()
+
+def summary_cache_path(key: str) -> str:
+    """
+    Content-addressed cache file for a `summary_key`.
+    """
+    return os.path.join(CACHE_DIR, key[:2], f"{key}.txt")
+
+def read_cache(path: str) -> Optional[str]:
+    """
+    Return the summary cached at `path`, or None if there is none yet.
+    """
+    try:
+        with open(path, encoding="utf-8") as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+def write_cache(path: str, summary: str):
+    """
+    Store `summary` at `path` atomically (tmp file + os.replace).
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(summary)
+    os.replace(tmp, path)
+
+async def cached_summary(key: str, prompt: str, model: str) -> str:
+    """
+    Return the summary stored on disk for `prompt`, or generate it and
+    store it atomically (tmp file + os.replace) for later runs.
+    """
+    path = summary_cache_path(key)
+    # disk I/O runs off the event loop, so crawls keep moving; on a
+    # re-run every chunk is a cache hit
+    summary = await asyncio.to_thread(read_cache, path)
+    if summary is not None:
+        return summary
+
+    summary = await generate_summary(prompt, model)
+    await asyncio.to_thread(write_cache, path, summary)
+    return summary
+
+# summary_key -> shared Task, least recently used first
+_summary_tasks: OrderedDict[str, asyncio.Task] = OrderedDict()
+SUMMARY_MEMO_SIZE = 8192
+
+def summary_task(key: str, prompt: str, model: str) -> asyncio.Task:
+    """
+    In-process layer above the disk cache: one shared Task per distinct
+    prompt, so duplicate chunks in a run (even in flight) cost one call.
+    Looked up by the short digest alone and bounded to SUMMARY_MEMO_SIZE;
+    a Task that fails is dropped so the next duplicate retries.
+    """
+    task = _summary_tasks.get(key)
+    if task is not None:
+        _summary_tasks.move_to_end(key)
+        return task
+    task = asyncio.ensure_future(cached_summary(key, prompt, model))
+    _summary_tasks[key] = task
+
+    def forget_failed(t: asyncio.Task):
+        if (t.cancelled() or t.exception()) and _summary_tasks.get(key) is t:
+            del _summary_tasks[key]
+
+    task.add_done_callback(forget_failed)
+    if len(_summary_tasks) > SUMMARY_MEMO_SIZE:
+        _summary_tasks.popitem(last=False)
+    return task
+
+async def summarize_chunk(chunk: str, model: str) -> str:
+    """
+    Summarize `chunk`, reusing a summary cached on disk or earlier in
+    this run when the same prompt has been seen before.
+    """
+    prompt = PROMPT_TMPL.format(chunk)
+    return await summary_task(summary_key(prompt, model), prompt, model)
+
+async def fetch_markdown(crawler: AsyncWebCrawler, url: str) -> str:
+    res = await crawler.arun(url=url, config=CRAWL_CFG)
+    if not res.success:
+        raise RuntimeError(f"Failed to crawl {url}: {res.error_message}")
+    return res.markdown
+
+def chunk_by_header(markdown: str) -> list[str]:
+    """
+    Split the entire MD into header‐led sections
+    (each starts with a `# ` or `## ` header).
+    """
+    starts = (m.start() for m in HEADER_PAT.finditer(markdown))
+    sections = []
+    start = next(starts, None)
+    if start is None:
+        return sections
+    for end in itertools.chain(starts, (len(markdown),)):
+        sec = markdown[start:end].strip()
+        if sec:
+            sections.append(sec)
+        start = end
+    return sections
 
-def chunk_text(text: str) -> list[str]:
+def chunk_by_paragraphs(section: str,
+                        max_chars: int = 2000,
+                        overlap_paras: int = 1
+                       ) -> list[str]:
+    """
+    Take a header‐section and split into chunks by whole paragraphs,
+    each ≤ max_chars. We optionally repeat the last N paragraphs
+    of a chunk at the start of the next to give overlap context.
+    """
+    paras = re.split(r'\n\s*\n', section.strip())
+    # prefix[i] = length of paras[:i], each counting its blank line, so
+    # any run's length is one subtraction instead of a re-sum
+    prefix = list(itertools.accumulate((len(p) + 2 for p in paras), initial=0))
     chunks = []
-    start  = 0
-    length = len(text)
-    while start < length:
-        end = min(start + MAX_CHARS, length)
-        chunks.append(text[start:end])
-        if end == length:
-            break
-        start = end - OVERLAP
+    lo = 0  # first paragraph of the chunk being built
+
+    for hi in range(1, len(paras)):
+        if prefix[hi + 1] - prefix[lo] > max_chars:
+            # flush current
+            chunks.append("\n\n".join(paras[lo:hi]).strip())
+            # keep the last overlap_paras for context
+            lo = max(lo, hi - overlap_paras)
+
+    chunks.append("\n\n".join(paras[lo:]).strip())
     return chunks
 
-def chunk_markdown(md: str) -> list[str]:
-    header_pat = re.compile(r'^(# .+|## .+)$', re.MULTILINE)
-    bounds = [m.start() for m in header_pat.finditer(md)] + [len(md)]
-    subchunks = []
-    for i in range(len(bounds) - 1):
-        piece = md[bounds[i]:bounds[i+1]].strip()
-        if piece:
-            subchunks.append(piece)
-    return subchunks
+def write_files(files: list[tuple[str, bytes]]) -> int:
+    """
+    Write a batch of finished chunk files, each as a single write(),
+    and return how many were written.
+    """
+    written = 0
+    for path, payload in files:
+        try:
+            with open(path, "wb") as f:
+                f.write(payload)
+        except OSError as e:
+            print(f"⚠️  Could not write {path}: {e}")
+            continue
+        written += 1
+    return written
 
 async def main():
     # 1) make sure model is available locally
     ensure_model(MODEL)
 
-    # 2) fetch & chunk
-    md = await fetch_markdown(URL)
-    top_chunks = chunk_text(md)
+    # 2) fetch
+    async with AsyncWebCrawler(config=BROWSER_CFG) as crawler:
+        md = await fetch_markdown(crawler, URL)
 
     # 3) decide output folder
     if SUBFOLDER:
@@ -118,20 +280,29 @@ async def main():
     out_dir = os.path.join(OUTPUT_DIR, folder)
     os.makedirs(out_dir, exist_ok=True)
 
-    # 4) summarize & write
-    counter = 1
-    for big in top_chunks:
-        for sub in chunk_markdown(big):
-            summary = summarize_chunk(sub, MODEL)
-            fn      = f"chunk_{counter:03}.md"
-            path    = os.path.join(out_dir, fn)
-            with open(path, "w", encoding="utf-8") as f:
-                f.write("Summary:\n")
-                f.write(summary + "\n\n")
-                f.write(sub)
-            counter += 1
+    # 4) split once by header, then by paragraph, and collect the chunks
+    pairs = []
+    for sec in chunk_by_header(md):
+        for sub in chunk_by_paragraphs(sec, MAX_CHARS, overlap_paras=1):
+            path = os.path.join(out_dir, f"chunk_{len(pairs)+1:03}.md")
+            pairs.append((path, sub))
+
+    saved = 0
+    for i in range(0, len(pairs), BATCH_SIZE):
+        batch = pairs[i:i + BATCH_SIZE]
+        summaries = await asyncio.gather(
+            *[summarize_chunk(sub, MODEL) for _, sub in batch]
+        )
+        files = [
+            (path, b"".join(
+                [b"Summary:\n", summary.encode("utf-8"), b"\n\n", sub.encode("utf-8")]
+            ))
+            for (path, sub), summary in zip(batch, summaries)
+        ]
+        # one trip off the event loop for the whole batch
+        saved += await asyncio.to_thread(write_files, files)
 
-    print(f"✅ Saved {counter-1} chunk files into {out_dir}")
+    print(f"✅ Saved {saved} chunk files into {out_dir}")
 
 if __name__ == "__main__":
     asyncio.run(main())
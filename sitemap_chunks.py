@@ -1,11 +1,17 @@
 import os
 import re
+import functools
+import hashlib
+import itertools
 import sys
 import subprocess
 import asyncio
 import requests
 import xml.etree.ElementTree as ET
+from typing import Iterator, Optional
+from collections import OrderedDict
 from urllib.parse import urlparse
+from ollama import AsyncClient, ResponseError
 from crawl4ai import AsyncWebCrawler, BrowserConfig, CrawlerRunConfig
 
 # ──────────── CONFIGURATION ────────────
@@ -18,129 +24,232 @@ OUTPUT_DIR = "out_chunks"
 SUBFOLDER  = None
 # Ollama model to use for summarization
 MODEL      = "gemma3:1b-it-qat"
+# Local Ollama server (HTTP API)
+OLLAMA_URL = "http://localhost:11434"
 # Chunking parameters
 MAX_CHARS  = 2000   # max characters per chunk
-OVERLAP    = 200    # overlapping characters between chunks
+# Max in-flight summarize requests; start the server with matching slots:
+#   OLLAMA_NUM_PARALLEL=8 OLLAMA_MAX_LOADED_MODELS=1 ollama serve
+# (unset, empty or 0 = "auto" on the server all fall back to 8 here)
+OLLAMA_NUM_PARALLEL = max(1, int(os.environ.get("OLLAMA_NUM_PARALLEL") or 8) or 8)
+# Chunks submitted together; ≤ OLLAMA_NUM_PARALLEL so the server batches them
+BATCH_SIZE = OLLAMA_NUM_PARALLEL
+# Pages crawled at once; 10–20 stays clear of most sites' rate limits
+CRAWL_CONCURRENCY = 10
+# Summaries are cached on disk across runs; bump PROMPT_VERSION to
+# invalidate them after changing the prompt or generation options
+CACHE_DIR      = os.path.join(".cache", "summaries")
+PROMPT_VERSION = 3
 # ────────────────────────────────────────
 
-def fetch_sitemap_urls(sitemap_url: str) -> list[str]:
+# Instruction first, chunk last and nothing per-call: every prompt shares
+# one prefix whose KV cache Ollama can reuse across chunks
+PROMPT_TMPL = (
+    "Please provide a 2–4 sentence summary of the following text:\n\n"
+    "{}\n\nSummary:"
+)
+
+# Generation options, identical on every call: a change would force Ollama
+# to reload the model and drop its cached prefix. num_keep is left to
+# the server, since the instruction's token count depends on the model.
+OLLAMA_OPTIONS = {
+    "num_ctx": 4096,
+    # 2–4 sentences fit well under 180 tokens; cap decode time
+    "num_predict": 180,
+    # stop at the first run of blank lines instead of rambling on, and
+    # stay close to the text so reruns give the same summary
+    "stop": ["\n\n\n"],
+    "temperature": 0.2,
+}
+# Keep the model (and its KV cache) loaded between batches
+OLLAMA_KEEP_ALIVE = "30m"
+
+# <loc> tags in the sitemap namespace, or un-namespaced
+LOC_TAGS = ("{http://www.sitemaps.org/schemas/sitemap/0.9}loc", "loc")
+
+# H1/H2 lines that start a new section; compiled once for every page
+HEADER_PAT = re.compile(r'(?m)^(?:# |## ).+$')
+
+# crawler settings, built once and shared by every page
+BROWSER_CFG = BrowserConfig(headless=True)
+CRAWL_CFG   = CrawlerRunConfig()
+
+# one client (and HTTP connection pool) for every /api/generate call
+_client = AsyncClient(host=OLLAMA_URL)
+
+def fetch_sitemap_urls(sitemap_url: str) -> Iterator[str]:
     """
-    Download and parse sitemap.xml, return all <loc> URLs.
+    Stream sitemap.xml and yield each <loc> URL as it is parsed.
     Falls back to regex if XML parsing fails.
     """
+    count = 0
+    with requests.get(sitemap_url, stream=True) as resp:
+        resp.raise_for_status()
+        resp.raw.decode_content = True  # undo gzip/deflate while streaming
+        try:
+            for _, el in ET.iterparse(resp.raw, events=("end",)):
+                if el.tag in LOC_TAGS and el.text:
+                    count += 1
+                    yield el.text.strip()
+                el.clear()
+            return
+        except ET.ParseError:
+            pass
+    # fallback regex, skipping the URLs streamed before the parse error
     resp = requests.get(sitemap_url)
     resp.raise_for_status()
-    data = resp.content
-    try:
-        root = ET.fromstring(data)
-        # sitemap namespace
-        ns = {"s": "http://www.sitemaps.org/schemas/sitemap/0.9"}
-        #ns = {"s": "https://rpstrength.com/sitemap_blogs_1.xml"}
-        locs = root.findall(".//s:loc", ns)
-        if not locs:
-            locs = root.findall(".//loc")
-        return [loc.text.strip() for loc in locs if loc.text]
-    except ET.ParseError:
-        # fallback regex
-        text = data.decode("utf-8", errors="ignore")
-        return re.findall(r"<loc>(.*?)</loc>", text)
+    text = resp.content.decode("utf-8", errors="ignore")
+    yield from itertools.islice(re.findall(r"<loc>(.*?)</loc>", text), count, None)
 
+@functools.lru_cache(maxsize=None)
 def ensure_model(model: str):
     """
-    Ensure the Ollama model is pulled locally.
+    Ensure the Ollama model is pulled locally (checked once per run).
     """
-    lst = subprocess.run(
-        ["ollama", "list", "models"],
-        capture_output=True, text=True
-    )
-    if lst.returncode != 0:
-        print("❗️ Cannot run `ollama list models`. Is Ollama installed?")
+    try:
+        resp = requests.get(f"{OLLAMA_URL}/api/tags", timeout=10)
+        resp.raise_for_status()
+    except requests.RequestException:
+        print(f"❗️ Cannot reach Ollama at {OLLAMA_URL}. Is `ollama serve` running?")
         sys.exit(1)
-    if model not in lst.stdout:
+    names = {m["name"] for m in resp.json().get("models", [])}
+    if model not in names and f"{model}:latest" not in names:
         print(f"⬇️ Pulling model {model}…")
         pull = subprocess.run(["ollama", "pull", model])
         if pull.returncode != 0:
             print(f"❗️ Failed to pull {model}")
             sys.exit(1)
 
-def summarize_chunk(chunk: str, model: str) -> str:
-    """
-    Run `ollama run <model>` with prompt on stdin, decode as UTF-8.
-    """
-    prompt = (
-        "Please provide a 2–4 sentence summary of the following text:\n\n"
-        f"{chunk}\n\nSummary:"
-    )
-    proc = subprocess.Popen(
-        ["ollama", "run", model],
-        stdin=subprocess.PIPE,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE
-    )
-    out_bytes, err_bytes = proc.communicate(prompt.encode("utf-8"))
-    out = out_bytes.decode("utf-8", errors="replace")
-    err = err_bytes.decode("utf-8", errors="replace")
-    if proc.returncode != 0:
-        if "could not connect to ollama app" in err:
-            print("\n❗️ Could not connect to the Ollama daemon.")
-            print("   • Start it with: ollama serve\n")
-            sys.exit(1)
-        raise RuntimeError(f"Ollama error: {err.strip()}")
-    return out.strip()
+async def generate_summary(prompt: str, model: str) -> str:
+    """
+    Run `prompt` through Ollama's HTTP API (/api/generate).
+    """
+    try:
+        r = await _client.generate(
+            model=model,
+            prompt=prompt,
+            stream=False,
+            options=OLLAMA_OPTIONS,
+            keep_alive=OLLAMA_KEEP_ALIVE,
+        )
+    except ConnectionError:
+        print("\n❗️ Could not connect to the Ollama daemon.")
+        print("   • Start it with: ollama serve\n")
+        sys.exit(1)
+    except ResponseError as e:
+        raise RuntimeError(f"Ollama error: {e.error}")
+    return r["response"].strip()
 
-async def fetch_markdown(url: str) -> str:
+def summary_key(prompt: str, model: str) -> str:
     """
-    Crawl the URL via Crawl4AI, return Markdown text.
+    Short content hash of a model/prompt pair. BLAKE2b is faster than
+    SHA-256 and collision resistance is all we need here.
     """
-    browser_cfg = BrowserConfig(headless=True)
-    crawl_cfg   = CrawlerRunConfig()
-    async with AsyncWebCrawler(config=browser_cfg) as crawler:
-        res = await crawler.arun(url=url, config=crawl_cfg)
-        if not res.success:
-            raise RuntimeError(f"Failed to crawl {url}: {res.error_message}")
-        return res.markdown
+    return hashlib.blake2b(
+        f"{model}\0{PROMPT_VERSION}\0{prompt}".encode("utf-8"),
+        digest_size=16
+    ).hexdigest()
 
-def chunk_text(text: str) -> list[str]:
+def summary_cache_path(key: str) -> str:
     """
-    Split text into fixed-size chunks with overlap.
+    Content-addressed cache file for a `summary_key`.
     """
-    chunks = []
-    start  = 0
-    length = len(text)
-    while start < length:
-        end = min(start + MAX_CHARS, length)
-        chunks.append(text[start:end])
-        if end == length:
-            break
-        start = end - OVERLAP
-    return chunks
+    return os.path.join(CACHE_DIR, key[:2], f"{key}.txt")
+
+def read_cache(path: str) -> Optional[str]:
+    """
+    Return the summary cached at `path`, or None if there is none yet.
+    """
+    try:
+        with open(path, encoding="utf-8") as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+def write_cache(path: str, summary: str):
+    """
+    Store `summary` at `path` atomically (tmp file + os.replace).
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(summary)
+    os.replace(tmp, path)
+
+async def cached_summary(key: str, prompt: str, model: str) -> str:
+    """
+    Return the summary stored on disk for `prompt`, or generate it and
+    store it atomically (tmp file + os.replace) for later runs.
+    """
+    path = summary_cache_path(key)
+    # disk I/O runs off the event loop, so crawls keep moving; on a
+    # re-run every chunk is a cache hit
+    summary = await asyncio.to_thread(read_cache, path)
+    if summary is not None:
+        return summary
+
+    summary = await generate_summary(prompt, model)
+    await asyncio.to_thread(write_cache, path, summary)
+    return summary
+
+# summary_key -> shared Task, least recently used first
+_summary_tasks: OrderedDict[str, asyncio.Task] = OrderedDict()
+SUMMARY_MEMO_SIZE = 8192
+
+def summary_task(key: str, prompt: str, model: str) -> asyncio.Task:
+    """
+    In-process layer above the disk cache: one shared Task per distinct
+    prompt, so duplicate chunks in a run (even in flight) cost one call.
+    Looked up by the short digest alone and bounded to SUMMARY_MEMO_SIZE;
+    a Task that fails is dropped so the next duplicate retries.
+    """
+    task = _summary_tasks.get(key)
+    if task is not None:
+        _summary_tasks.move_to_end(key)
+        return task
+    task = asyncio.ensure_future(cached_summary(key, prompt, model))
+    _summary_tasks[key] = task
+
+    def forget_failed(t: asyncio.Task):
+        if (t.cancelled() or t.exception()) and _summary_tasks.get(key) is t:
+            del _summary_tasks[key]
+
+    task.add_done_callback(forget_failed)
+    if len(_summary_tasks) > SUMMARY_MEMO_SIZE:
+        _summary_tasks.popitem(last=False)
+    return task
 
-def chunk_markdown(md: str) -> list[str]:
+async def summarize_chunk(chunk: str, model: str) -> str:
     """
-    Split a markdown chunk further at H1/H2 headers.
+    Summarize `chunk`, reusing any cached summary of the same prompt.
     """
-    header_pat = re.compile(r'^(# .+|## .+)$', re.MULTILINE)
-    bounds = [m.start() for m in header_pat.finditer(md)] + [len(md)]
-    subs = []
-    for i in range(len(bounds) - 1):
-        piece = md[bounds[i]:bounds[i+1]].strip()
-        if piece:
-            subs.append(piece)
-    return subs
+    prompt = PROMPT_TMPL.format(chunk)
+    return await summary_task(summary_key(prompt, model), prompt, model)
 
+async def fetch_markdown(crawler: AsyncWebCrawler, url: str) -> str:
+    """
+    Crawl the URL via the shared Crawl4AI crawler, return Markdown text.
+    """
+    res = await crawler.arun(url=url, config=CRAWL_CFG)
+    if not res.success:
+        raise RuntimeError(f"Failed to crawl {url}: {res.error_message}")
+    return res.markdown
 
 def chunk_by_header(markdown: str) -> list[str]:
     """
     Split the entire MD into header‐led sections
     (each starts with a `# ` or `## ` header).
     """
-    header_pat = re.compile(r'^(# .+|## .+)$', re.MULTILINE)
-    bounds = [m.start() for m in header_pat.finditer(markdown)] + [len(markdown)]
+    starts = (m.start() for m in HEADER_PAT.finditer(markdown))
     sections = []
-    for i in range(len(bounds)-1):
-        sec = markdown[bounds[i]:bounds[i+1]].strip()
+    start = next(starts, None)
+    if start is None:
+        return sections
+    for end in itertools.chain(starts, (len(markdown),)):
+        sec = markdown[start:end].strip()
         if sec:
             sections.append(sec)
+        start = end
     return sections
 
 def chunk_by_paragraphs(section: str,
@@ -153,65 +262,119 @@ def chunk_by_paragraphs(section: str,
     of a chunk at the start of the next to give overlap context.
     """
     paras = re.split(r'\n\s*\n', section.strip())
+    # prefix[i] = length of paras[:i], each counting its blank line, so
+    # any run's length is one subtraction instead of a re-sum
+    prefix = list(itertools.accumulate((len(p) + 2 for p in paras), initial=0))
     chunks = []
-    curr = []
-    curr_len = 0
+    lo = 0  # first paragraph of the chunk being built
 
-    for p in paras:
-        plen = len(p) + 2  # account for the blank line
-        if curr_len + plen > max_chars and curr:
+    for hi in range(1, len(paras)):
+        if prefix[hi + 1] - prefix[lo] > max_chars:
             # flush current
-            chunks.append("\n\n".join(curr).strip())
+            chunks.append("\n\n".join(paras[lo:hi]).strip())
             # keep the last overlap_paras for context
-            curr = curr[-overlap_paras:]
-            curr_len = sum(len(x)+2 for x in curr)
-        curr.append(p)
-        curr_len += plen
+            lo = max(lo, hi - overlap_paras)
 
-    if curr:
-        chunks.append("\n\n".join(curr).strip())
+    chunks.append("\n\n".join(paras[lo:]).strip())
     return chunks
 
+def write_files(files: list[tuple[str, bytes]]) -> int:
+    """
+    Write a batch of finished chunk files, each as a single write(),
+    and return how many were written.
+    """
+    written = 0
+    for path, payload in files:
+        try:
+            with open(path, "wb") as f:
+                f.write(payload)
+        except OSError as e:
+            print(f"⚠️  Could not write {path}: {e}")
+            continue
+        written += 1
+    return written
+
 async def main():
     # 1) Ensure model is available
     ensure_model(MODEL)
 
     # 2) Build list of target URLs
     if URL.lower().endswith(".xml") or "sitemap" in URL.lower():
-        targets = fetch_sitemap_urls(URL)
+        targets = list(fetch_sitemap_urls(URL))
         print(f"🔍 Found {len(targets)} URLs in sitemap.")
     else:
         targets = [URL]
 
-    counter = 1
-    for target in targets:
-        print(f"\n▶️ Processing {target}")
-        try:
-            md = await fetch_markdown(target)
-        except Exception as e:
-            # <-- catch *any* failure in crawling
-            print(f"⚠️  Skipping {target} due to error:\n    {e}")
-            continue
+    sem = asyncio.Semaphore(OLLAMA_NUM_PARALLEL)
+    crawl_sem = asyncio.Semaphore(CRAWL_CONCURRENCY)
+
+    async def summarize(sub: str) -> str:
+        async with sem:
+            return await summarize_chunk(sub, MODEL)
+
+    saved = 0
+    pending = []  # (path, chunk) pairs waiting for a full batch
+
+    async def flush(batch: list[tuple[str, str]]):
+        nonlocal saved
+        # a batch mixes pages, so one failed summary must not sink the rest
+        summaries = await asyncio.gather(
+            *[summarize(sub) for _, sub in batch], return_exceptions=True
+        )
+        files = []
+        for (path, sub), summary in zip(batch, summaries):
+            if isinstance(summary, Exception):
+                print(f"⚠️  Not saving {path}: {summary}")
+                continue
+            files.append((path, b"".join(
+                [b"Summary:\n", summary.encode("utf-8"), b"\n\n", sub.encode("utf-8")]
+            )))
+        # one trip off the event loop for the whole batch
+        saved += await asyncio.to_thread(write_files, files)
+
+    async def worker(crawler: AsyncWebCrawler, page: int, target: str):
+        nonlocal pending
+        async with crawl_sem:
+            print(f"\n▶️ Processing {target}")
+            try:
+                md = await fetch_markdown(crawler, target)
+            except Exception as e:
+                # <-- catch *any* failure in crawling
+                print(f"⚠️  Skipping {target} due to error:\n    {e}")
+                return
+
+            # chunk as before; summarize whenever a batch fills up
+            out_dir = os.path.join(
+                OUTPUT_DIR,
+                SUBFOLDER or f"{os.path.splitext(os.path.basename(urlparse(target).path))[0] or 'page'}_chunks"
+            )
+            os.makedirs(out_dir, exist_ok=True)
+            # numbered by the page's place in the sitemap, not by which
+            # crawl finished first, so names are the same on every run
+            n = 0
+            for sec in chunk_by_header(md):
+                for sub in chunk_by_paragraphs(sec, MAX_CHARS, overlap_paras=1):
+                    n += 1
+                    path = os.path.join(out_dir, f"chunk_{page:05}_{n:03}.md")
+                    pending.append((path, sub))
+                    if len(pending) >= BATCH_SIZE:
+                        batch, pending = pending, []
+                        await flush(batch)
+
+    # one browser for the whole run; a failing page doesn't abort the batch
+    async with AsyncWebCrawler(config=BROWSER_CFG) as crawler:
+        results = await asyncio.gather(
+            *[worker(crawler, i, t) for i, t in enumerate(targets, 1)],
+            return_exceptions=True
+        )
+    for target, res in zip(targets, results):
+        if isinstance(res, Exception):
+            print(f"⚠️  Failed {target}: {res}")
+    # chunks left over from the last, partial batch
+    if pending:
+        await flush(pending)
 
-        # chunk + summarize as before
-        sections = chunk_by_header(md)
-        for sec in sections:
-            for sub in chunk_by_paragraphs(sec, MAX_CHARS, overlap_paras=1):
-                summary = summarize_chunk(sub, MODEL)
-                fn      = f"chunk_{counter:05}.md"
-                out_dir = os.path.join(
-                    OUTPUT_DIR,
-                    SUBFOLDER or f"{os.path.splitext(os.path.basename(urlparse(target).path))[0] or 'page'}_chunks"
-                )
-                os.makedirs(out_dir, exist_ok=True)
-                path = os.path.join(out_dir, fn)
-                with open(path, "w", encoding="utf-8") as f:
-                    f.write("Summary:\n")
-                    f.write(summary + "\n\n")
-                    f.write(sub)
-                counter += 1
-
-    print(f"\n✅ Saved {counter-1} chunk files into {OUTPUT_DIR}")
+    print(f"\n✅ Saved {saved} chunk files into {OUTPUT_DIR}")
 
 if __name__ == "__main__":
     asyncio.run(main())
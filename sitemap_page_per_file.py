@@ -1,11 +1,18 @@
 import os
 import re
+import itertools
+import functools
+import hashlib
 import sys
 import subprocess
 import asyncio
+import aiofiles
 import requests
 import xml.etree.ElementTree as ET
+from typing import Iterator, Optional
+from collections import OrderedDict
 from urllib.parse import urlparse
+from ollama import AsyncClient, ResponseError
 from crawl4ai import AsyncWebCrawler, BrowserConfig, CrawlerRunConfig
 
 # ──────────── CONFIGURATION ────────────
@@ -14,106 +21,246 @@ from crawl4ai import AsyncWebCrawler, BrowserConfig, CrawlerRunConfig
 URL        = "https://rpstrength.com/sitemap_blogs_1.xml"
 OUTPUT_DIR = "out_posts"
 MODEL      = "gemma3:1b-it-qat"
+# Local Ollama server (HTTP API)
+OLLAMA_URL = "http://localhost:11434"
+# Pages crawled at once; 10–20 stays clear of most sites' rate limits
+CRAWL_CONCURRENCY = 10
+# Summaries are cached on disk across runs; bump PROMPT_VERSION to
+# invalidate them after changing the prompt or generation options
+CACHE_DIR      = os.path.join(".cache", "summaries")
+PROMPT_VERSION = 3
 # ────────────────────────────────────────
 
-def fetch_sitemap_urls(sitemap_url: str) -> list[str]:
-    """Download & parse <loc> entries from sitemap.xml."""
+# Instruction first, chunk last and nothing per-call: every prompt shares
+# one prefix whose KV cache Ollama can reuse across chunks
+PROMPT_TMPL = (
+    "Please provide a 2–4 sentence summary of the following text:\n\n"
+    "{}\n\nSummary:"
+)
+
+# Generation options, identical on every call: a change would force Ollama
+# to reload the model and drop its cached prefix. num_keep is left to
+# the server, since the instruction's token count depends on the model.
+OLLAMA_OPTIONS = {
+    "num_ctx": 4096,
+    # 2–4 sentences fit well under 180 tokens; cap decode time
+    "num_predict": 180,
+    # stop at the first run of blank lines instead of rambling on, and
+    # stay close to the text so reruns give the same summary
+    "stop": ["\n\n\n"],
+    "temperature": 0.2,
+}
+# Keep the model (and its KV cache) loaded between batches
+OLLAMA_KEEP_ALIVE = "30m"
+
+# <loc> tags in the sitemap namespace, or un-namespaced
+LOC_TAGS = ("{http://www.sitemaps.org/schemas/sitemap/0.9}loc", "loc")
+
+# crawler settings, built once and shared by every page
+BROWSER_CFG = BrowserConfig(headless=True)
+CRAWL_CFG   = CrawlerRunConfig()
+
+# one client (and HTTP connection pool) for every /api/generate call
+_client = AsyncClient(host=OLLAMA_URL)
+
+def fetch_sitemap_urls(sitemap_url: str) -> Iterator[str]:
+    """Stream sitemap.xml and yield its <loc> entries as they are parsed."""
+    count = 0
+    with requests.get(sitemap_url, stream=True) as resp:
+        resp.raise_for_status()
+        resp.raw.decode_content = True  # undo gzip/deflate while streaming
+        try:
+            for _, el in ET.iterparse(resp.raw, events=("end",)):
+                if el.tag in LOC_TAGS and el.text:
+                    count += 1
+                    yield el.text.strip()
+                el.clear()
+            return
+        except ET.ParseError:
+            pass
+    # fallback regex, skipping the URLs streamed before the parse error
     resp = requests.get(sitemap_url)
     resp.raise_for_status()
-    data = resp.content
-    try:
-        root = ET.fromstring(data)
-        ns = {"s": "http://www.sitemaps.org/schemas/sitemap/0.9"}
-        locs = root.findall(".//s:loc", ns) or root.findall(".//loc")
-        return [loc.text.strip() for loc in locs if loc.text]
-    except ET.ParseError:
-        text = data.decode("utf-8", errors="ignore")
-        return re.findall(r"<loc>(.*?)</loc>", text)
+    text = resp.content.decode("utf-8", errors="ignore")
+    yield from itertools.islice(re.findall(r"<loc>(.*?)</loc>", text), count, None)
 
+@functools.lru_cache(maxsize=None)
 def ensure_model(model: str):
-    """Pull the Ollama model if it isn’t already present."""
-    lst = subprocess.run(
-        ["ollama", "list", "models"], capture_output=True, text=True
-    )
-    if lst.returncode != 0:
-        print("❗️ Cannot run `ollama list models`. Is Ollama installed?")
+    """Pull the Ollama model if it isn’t already present (checked once per run)."""
+    try:
+        resp = requests.get(f"{OLLAMA_URL}/api/tags", timeout=10)
+        resp.raise_for_status()
+    except requests.RequestException:
+        print(f"❗️ Cannot reach Ollama at {OLLAMA_URL}. Is `ollama serve` running?")
         sys.exit(1)
-    if model not in lst.stdout:
+    names = {m["name"] for m in resp.json().get("models", [])}
+    if model not in names and f"{model}:latest" not in names:
         print(f"⬇️ Pulling model {model}…")
         pull = subprocess.run(["ollama", "pull", model])
         if pull.returncode != 0:
             print(f"❗️ Failed to pull {model}")
             sys.exit(1)
 
-def summarize_chunk(text: str, model: str) -> str:
-    """
-    Summarize *all* of `text` in 2–4 sentences, feeding prompt via stdin.
-    """
-    prompt = (
-        "Please provide a 2–4 sentence summary of the following text:\n\n"
-        f"{text}\n\nSummary:"
-    )
-    proc = subprocess.Popen(
-        ["ollama", "run", model],
-        stdin=subprocess.PIPE,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-    )
-    outb, errb = proc.communicate(prompt.encode("utf-8"))
-    out = outb.decode("utf-8", errors="replace").strip()
-    err = errb.decode("utf-8", errors="replace")
-    if proc.returncode != 0:
-        if "could not connect to ollama app" in err.lower():
-            print("\n❗️ Could not connect to Ollama daemon. Run `ollama serve`.")
-            sys.exit(1)
-        raise RuntimeError(f"Ollama error: {err.strip()}")
-    return out
-
-async def fetch_markdown(url: str) -> str:
-    """Use Crawl4AI to scrape the page and return its Markdown."""
-    browser_cfg = BrowserConfig(headless=True)
-    crawl_cfg   = CrawlerRunConfig()
-    async with AsyncWebCrawler(config=browser_cfg) as crawler:
-        res = await crawler.arun(url=url, config=crawl_cfg)
-        if not res.success:
-            raise RuntimeError(f"Failed to crawl {url}: {res.error_message}")
-        return res.markdown
+async def generate_summary(prompt: str, model: str) -> str:
+    """
+    Run `prompt` through Ollama's HTTP API (/api/generate).
+    """
+    try:
+        r = await _client.generate(
+            model=model,
+            prompt=prompt,
+            stream=False,
+            options=OLLAMA_OPTIONS,
+            keep_alive=OLLAMA_KEEP_ALIVE,
+        )
+    except ConnectionError:
+        print("\n❗️ Could not connect to Ollama daemon. Run `ollama serve`.")
+        sys.exit(1)
+    except ResponseError as e:
+        raise RuntimeError(f"Ollama error: {e.error}")
+    return r["response"].strip()
+
+def summary_key(prompt: str, model: str) -> str:
+    """
+    Short content hash of a model/prompt pair. BLAKE2b is faster than
+    SHA-256 and collision resistance is all we need here.
+    """
+    return hashlib.blake2b(
+        f"{model}\0{PROMPT_VERSION}\0{prompt}".encode("utf-8"),
+        digest_size=16
+    ).hexdigest()
+
+def summary_cache_path(key: str) -> str:
+    """
+    Content-addressed cache file for a `summary_key`.
+    """
+    return os.path.join(CACHE_DIR, key[:2], f"{key}.txt")
+
+def read_cache(path: str) -> Optional[str]:
+    """
+    Return the summary cached at `path`, or None if there is none yet.
+    """
+    try:
+        with open(path, encoding="utf-8") as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+def write_cache(path: str, summary: str):
+    """
+    Store `summary` at `path` atomically (tmp file + os.replace).
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(summary)
+    os.replace(tmp, path)
+
+async def cached_summary(key: str, prompt: str, model: str) -> str:
+    """
+    Return the summary stored on disk for `prompt`, or generate it and
+    store it atomically (tmp file + os.replace) for later runs.
+    """
+    path = summary_cache_path(key)
+    # disk I/O runs off the event loop, so crawls keep moving; on a
+    # re-run every chunk is a cache hit
+    summary = await asyncio.to_thread(read_cache, path)
+    if summary is not None:
+        return summary
+
+    summary = await generate_summary(prompt, model)
+    await asyncio.to_thread(write_cache, path, summary)
+    return summary
+
+# summary_key -> shared Task, least recently used first
+_summary_tasks: OrderedDict[str, asyncio.Task] = OrderedDict()
+SUMMARY_MEMO_SIZE = 8192
+
+def summary_task(key: str, prompt: str, model: str) -> asyncio.Task:
+    """
+    In-process layer above the disk cache: one shared Task per distinct
+    prompt, so duplicate chunks in a run (even in flight) cost one call.
+    Looked up by the short digest alone and bounded to SUMMARY_MEMO_SIZE;
+    a Task that fails is dropped so the next duplicate retries.
+    """
+    task = _summary_tasks.get(key)
+    if task is not None:
+        _summary_tasks.move_to_end(key)
+        return task
+    task = asyncio.ensure_future(cached_summary(key, prompt, model))
+    _summary_tasks[key] = task
+
+    def forget_failed(t: asyncio.Task):
+        if (t.cancelled() or t.exception()) and _summary_tasks.get(key) is t:
+            del _summary_tasks[key]
+
+    task.add_done_callback(forget_failed)
+    if len(_summary_tasks) > SUMMARY_MEMO_SIZE:
+        _summary_tasks.popitem(last=False)
+    return task
+
+async def summarize_chunk(text: str, model: str) -> str:
+    """
+    Summarize *all* of `text` in 2–4 sentences, reusing any cached summary.
+    """
+    prompt = PROMPT_TMPL.format(text)
+    return await summary_task(summary_key(prompt, model), prompt, model)
+
+async def fetch_markdown(crawler: AsyncWebCrawler, url: str) -> str:
+    """Use the shared Crawl4AI crawler to scrape the page and return its Markdown."""
+    res = await crawler.arun(url=url, config=CRAWL_CFG)
+    if not res.success:
+        raise RuntimeError(f"Failed to crawl {url}: {res.error_message}")
+    return res.markdown
 
 async def main():
     ensure_model(MODEL)
 
     # build list of pages
     if URL.lower().endswith(".xml") or "sitemap" in URL.lower():
-        targets = fetch_sitemap_urls(URL)
+        targets = list(fetch_sitemap_urls(URL))
         print(f"🔍 Found {len(targets)} URLs in sitemap.")
     else:
         targets = [URL]
 
     os.makedirs(OUTPUT_DIR, exist_ok=True)
     count = 0
+    sem = asyncio.Semaphore(CRAWL_CONCURRENCY)
 
-    for target in targets:
-        print(f"\n▶️  Processing {target}")
-        try:
-            md = await fetch_markdown(target)
-        except Exception as e:
-            print(f"⚠️  Skipping {target} due to: {e}")
-            continue
+    async def worker(crawler: AsyncWebCrawler, target: str):
+        nonlocal count
+        async with sem:
+            print(f"\n▶️  Processing {target}")
+            try:
+                md = await fetch_markdown(crawler, target)
+            except Exception as e:
+                print(f"⚠️  Skipping {target} due to: {e}")
+                return
+
+            summary = await summarize_chunk(md, MODEL)
 
-        summary = summarize_chunk(md, MODEL)
+            # derive a safe filename from the URL path
+            slug = os.path.splitext(os.path.basename(urlparse(target).path))[0] or "index"
+            filename = f"{slug}.md"
+            out_path = os.path.join(OUTPUT_DIR, filename)
 
-        # derive a safe filename from the URL path
-        slug = os.path.splitext(os.path.basename(urlparse(target).path))[0] or "index"
-        filename = f"{slug}.md"
-        out_path = os.path.join(OUTPUT_DIR, filename)
+            payload = b"".join(
+                [b"Summary:\n", summary.encode("utf-8"), b"\n\n", md.encode("utf-8")]
+            )
+            async with aiofiles.open(out_path, "wb") as f:
+                await f.write(payload)
 
-        with open(out_path, "w", encoding="utf-8") as f:
-            f.write("Summary:\n")
-            f.write(summary + "\n\n")
-            f.write(md)
+            count += 1
+            print(f"✅ Wrote {out_path}")
 
-        count += 1
-        print(f"✅ Wrote {out_path}")
+    # one browser for the whole run; a failing page doesn't abort the batch
+    async with AsyncWebCrawler(config=BROWSER_CFG) as crawler:
+        results = await asyncio.gather(
+            *[worker(crawler, t) for t in targets], return_exceptions=True
+        )
+    for target, res in zip(targets, results):
+        if isinstance(res, Exception):
+            print(f"⚠️  Failed {target}: {res}")
 
     print(f"\n🎉 Completed. Wrote {count} files into {OUTPUT_DIR}")
 
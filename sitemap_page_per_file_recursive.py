@@ -1,14 +1,24 @@
 import os
-import json
+import contextlib
+import functools
+import hashlib
+import logging
 import re
 import sys
 import subprocess
 import asyncio
+import aiofiles
+import aiohttp
 import requests
 import html2text
+from readability import Document
 import xml.etree.ElementTree as ET
+from collections import OrderedDict
+from typing import Optional
 from urllib.parse import urlparse
-from crawl4ai import AsyncWebCrawler, BrowserConfig, CrawlerRunConfig
+from ollama import AsyncClient, ResponseError
+from crawl4ai import (AsyncWebCrawler, BrowserConfig, CrawlerRunConfig,
+                      DefaultMarkdownGenerator, PruningContentFilter)
 
 # ──────────── CONFIGURATION ────────────
 # Can be a sitemap.xml or a single .md/.txt URL
@@ -17,8 +27,43 @@ from crawl4ai import AsyncWebCrawler, BrowserConfig, CrawlerRunConfig
 URL        = "https://faroutride.com/sitemap_index.xml"
 OUTPUT_DIR = "out_posts"
 MODEL      = "gemma3:1b-it-qat"
+# Local Ollama server (HTTP API)
+OLLAMA_URL = "http://localhost:11434"
+# Pages crawled at once; 10–20 stays clear of most sites' rate limits
+CRAWL_CONCURRENCY = 10
+# Child sitemaps of a sitemap index fetched at once
+SITEMAP_CONCURRENCY = 10
+# Summaries are cached on disk across runs; bump PROMPT_VERSION to
+# invalidate them after changing the prompt or generation options
+CACHE_DIR      = os.path.join(".cache", "summaries")
+PROMPT_VERSION = 3
 # ────────────────────────────────────────
 
+# Instruction first, chunk last and nothing per-call: every prompt shares
+# one prefix whose KV cache Ollama can reuse across chunks
+PROMPT_TMPL = (
+    "Please provide a formal 2–4 sentence summary of the main portion of the following text, please focus on the main portion of the text and ignore the header sorts of stuff like menue and search:\n\n"
+    "{}\n\nSummary:"
+)
+
+# Generation options, identical on every call: a change would force Ollama
+# to reload the model and drop its cached prefix. num_keep is left to
+# the server, since the instruction's token count depends on the model.
+OLLAMA_OPTIONS = {
+    "num_ctx": 4096,
+    # 2–4 sentences fit well under 180 tokens; cap decode time
+    "num_predict": 180,
+    # stop at the first run of blank lines instead of rambling on, and
+    # stay close to the text so reruns give the same summary
+    "stop": ["\n\n\n"],
+    "temperature": 0.2,
+}
+# Keep the model (and its KV cache) loaded between batches
+OLLAMA_KEEP_ALIVE = "30m"
+
+# one client (and HTTP connection pool) for every /api/generate call
+_client = AsyncClient(host=OLLAMA_URL)
+
 # A realistic User-Agent string so servers don’t 403 us
 REQUEST_HEADERS = {
     "User-Agent": (
@@ -28,206 +73,372 @@ REQUEST_HEADERS = {
     )
 }
 
-def fetch_sitemap_urls(sitemap_url: str,
-                       visited: set[str] = None
-                      ) -> list[str]:
+# crawler settings, built once and shared by every page; verbose=False
+# plus the logger levels keep Crawl4AI/Playwright quiet at the source
+BROWSER_CFG = BrowserConfig(headless=True, verbose=False)
+CRAWL_CFG   = CrawlerRunConfig(
+    page_timeout=30_000,
+    wait_for="css:body",
+    # also produce `fit_markdown`: the page with nav/footer chrome pruned
+    markdown_generator=DefaultMarkdownGenerator(
+        content_filter=PruningContentFilter()
+    ),
+    verbose=False
+)
+logging.getLogger("crawl4ai").setLevel(logging.CRITICAL)
+logging.getLogger("playwright").setLevel(logging.CRITICAL)
+
+# Retry policy for every HTTP fetch (sitemaps and fallback pages)
+RETRY_TOTAL    = 3
+RETRY_BACKOFF  = 0.3   # seconds; doubles after each attempt
+RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+
+# Lines that are site chrome rather than content: bare nav labels,
+# copyright footers and (bulleted) lines made only of links, optionally
+# separated by | · • / , or -
+_MD_LINK = r'\[[^\]\n]+\]\([^)\n]+\)'
+BOILERPLATE_PAT = re.compile(
+    r'(?m)^(?:(?:Home|Menu|Search|Subscribe|© .+)'
+    r'|[ \t]*(?:[*+-][ \t]+)?' + _MD_LINK +
+    r'(?:[ \t]*[|·•/,-]?[ \t]*' + _MD_LINK + r')*[ \t]*)$\n?'
+)
+
+def http_session() -> aiohttp.ClientSession:
+    """
+    Pooled aiohttp session with our browser-like headers; connect/read
+    timeouts of 10 s, like the old `requests` calls.
+    """
+    return aiohttp.ClientSession(
+        headers=REQUEST_HEADERS,
+        timeout=aiohttp.ClientTimeout(sock_connect=10, sock_read=10),
+        connector=aiohttp.TCPConnector(limit=20),
+    )
+
+@contextlib.asynccontextmanager
+async def get_with_retry(session: aiohttp.ClientSession, url: str):
+    """
+    `session.get(url)`, retried up to RETRY_TOTAL times with exponential
+    backoff on connection errors and RETRY_STATUSES (honouring a numeric
+    Retry-After). Yields the last response; callers still raise_for_status().
+    """
+    for attempt in range(RETRY_TOTAL + 1):
+        delay = RETRY_BACKOFF * 2 ** attempt
+        try:
+            resp = await session.get(url)
+        except aiohttp.ClientConnectionError:
+            if attempt == RETRY_TOTAL:
+                raise
+            await asyncio.sleep(delay)
+            continue
+        if resp.status in RETRY_STATUSES and attempt < RETRY_TOTAL:
+            retry_after = resp.headers.get("Retry-After", "")
+            resp.release()
+            await asyncio.sleep(int(retry_after) if retry_after.isdigit() else delay)
+            continue
+        break
+    try:
+        yield resp
+    finally:
+        resp.release()
+
+async def fetch_sitemap_urls(session: aiohttp.ClientSession,
+                             sitemap_url: str,
+                             visited: set[str] = None,
+                             sem: asyncio.Semaphore = None
+                            ) -> list[str]:
     """
-    Recursively fetch all <loc> URLs from a sitemap or sitemap-index,
-    using a browser-like User-Agent to avoid 403s.
+    Recursively fetch all <loc> URLs from a sitemap or sitemap-index.
+    Each document is stream-parsed as it downloads, and the children of
+    an index are fetched concurrently (SITEMAP_CONCURRENCY at a time).
     """
     if visited is None:
         visited = set()
+    if sem is None:
+        sem = asyncio.Semaphore(SITEMAP_CONCURRENCY)
     if sitemap_url in visited:
         return []
     visited.add(sitemap_url)
 
-    # use a Session with our headers
-    session = requests.Session()
-    session.headers.update(REQUEST_HEADERS)
-
-    resp = session.get(sitemap_url, timeout=10)
-    resp.raise_for_status()
-    data = resp.content
-
-    try:
-        root = ET.fromstring(data)
-    except ET.ParseError:
-        # fallback: regex scrape of all <loc>…</loc>
-        text = data.decode("utf-8", errors="ignore")
-        return re.findall(r"<loc>\s*(.*?)\s*</loc>", text)
-
-    tag = root.tag.split("}")[-1].lower()
     urls: list[str] = []
+    children: list[str] = []  # child sitemaps, fetched after parsing
+    async with sem:
+        async with get_with_retry(session, sitemap_url) as resp:
+            resp.raise_for_status()
+            parser = ET.XMLPullParser(events=("start", "end"))
+            root, kind, depth = None, None, 0
+            malformed = False
+            try:
+                async for block in resp.content.iter_chunked(64 * 1024):
+                    parser.feed(block)
+                    for ev, el in parser.read_events():
+                        if ev == "start":
+                            depth += 1
+                            if root is None:
+                                root, kind = el, el.tag.split("}")[-1].lower()
+                            continue
+                        if el.tag.split("}")[-1] == "loc" and el.text:
+                            # <sitemap>/<url> entries carry their own <loc> at
+                            # depth 3; for an unknown variant grab every <loc>
+                            if kind == "sitemapindex" and depth == 3:
+                                children.append(el.text.strip())
+                            elif depth == 3 or kind not in ("sitemapindex", "urlset"):
+                                urls.append(el.text.strip())
+                        elif depth == 2:
+                            # finished one entry; drop it so the tree stays tiny
+                            root.clear()
+                        depth -= 1
+                parser.close()
+            except ET.ParseError:
+                malformed = True
 
-    if tag == "sitemapindex":
-        for sm in root.findall(".//{*}sitemap"):
-            loc = sm.find("{*}loc")
-            if loc is not None and loc.text:
-                child = loc.text.strip()
-                urls += fetch_sitemap_urls(child, visited)
-    elif tag == "urlset":
-        for urln in root.findall(".//{*}url"):
-            loc = urln.find("{*}loc")
-            if loc is not None and loc.text:
-                urls.append(loc.text.strip())
-    else:
-        # unknown variant: grab every <loc>
-        for loc in root.findall(".//{*}loc"):
-            if loc.text:
-                urls.append(loc.text.strip())
+        if malformed:
+            # fallback: regex scrape of all <loc>…</loc>
+            children = []
+            async with get_with_retry(session, sitemap_url) as resp:
+                resp.raise_for_status()
+                text = (await resp.read()).decode("utf-8", errors="ignore")
+            urls = re.findall(r"<loc>\s*(.*?)\s*</loc>", text)
 
+    # the semaphore is released first, so children can take its slots
+    for child_urls in await asyncio.gather(
+        *[fetch_sitemap_urls(session, child, visited, sem) for child in children]
+    ):
+        urls += child_urls
     return urls
 
+@functools.lru_cache(maxsize=None)
 def ensure_model(model: str):
     """
     Ensure that `model` is present locally.
-    1) Try `ollama list models --json`
-    2) Fallback to parsing `ollama list models`
-    3) If *neither* yields any names, warn & skip auto-pull.
-    4) Otherwise, pull only if missing.
+    1) One GET of /api/tags – the same list `ollama list` shows.
+    2) Pull only if missing.
+    Cached per model, so repeat calls in a run are free.
     """
-    names = []
-    # 1) JSON listing
     try:
-        proc = subprocess.run(
-            ["ollama", "list", "models", "--json"],
-            capture_output=True, text=True
-        )
-        if proc.returncode == 0:
-            data = json.loads(proc.stdout)
-            # JSON is usually a list of dicts with "name" keys
-            names = [m.get("name") for m in data if isinstance(m, dict) and m.get("name")]
-    except Exception:
-        pass
-
-    # 2) Plain-text fallback
-    if not names:
-        proc = subprocess.run(
-            ["ollama", "list", "models"],
-            capture_output=True, text=True
-        )
-        if proc.returncode == 0:
-            for line in proc.stdout.splitlines():
-                line = line.strip()
-                # skip headers or empty lines
-                if not line or line.lower().startswith("name"):
-                    continue
-                # first whitespace-delimited token is the model name
-                parts = line.split()
-                if parts:
-                    names.append(parts[0])
-
-    # 3) If we still got nothing, bail out of auto-pull
-    if not names:
-        print(f"⚠️  Could not detect any local Ollama models (parsed 0 names).")
-        print(f"   Please ensure you have already run:\n     ollama pull {model}\n")
-        return
-
-    # 4) If your model isn’t in the list, pull it
-    if model not in names:
+        resp = requests.get(f"{OLLAMA_URL}/api/tags", timeout=10)
+        resp.raise_for_status()
+    except requests.RequestException:
+        print(f"❗️ Cannot reach Ollama at {OLLAMA_URL}. Is `ollama serve` running?")
+        sys.exit(1)
+    names = {m["name"] for m in resp.json().get("models", [])}
+    if model not in names and f"{model}:latest" not in names:
         print(f"⬇️ Pulling model {model}…")
         pull = subprocess.run(["ollama", "pull", model])
         if pull.returncode != 0:
             print(f"❗️ Failed to pull {model}")
             sys.exit(1)
 
-def summarize_chunk(text: str, model: str) -> str:
+async def generate_summary(prompt: str, model: str) -> str:
     """
-    Summarize *all* of `text` in 2–4 sentences, feeding prompt via stdin.
+    Run `prompt` through Ollama's HTTP API (/api/generate).
     """
-    prompt = (
-        "Please provide a formal 2–4 sentence summary of the main portion of the following text, please focus on the main portion of the text and ignore the header sorts of stuff like menue and search:\n\n"
-        f"{text}\n\nSummary:"
-    )
-    proc = subprocess.Popen(
-        ["ollama", "run", model],
-        stdin=subprocess.PIPE,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-    )
-    outb, errb = proc.communicate(prompt.encode("utf-8"))
-    out = outb.decode("utf-8", errors="replace").strip()
-    err = errb.decode("utf-8", errors="replace")
-    if proc.returncode != 0:
-        if "could not connect to ollama app" in err.lower():
-            print("\n❗️ Could not connect to Ollama daemon. Run `ollama serve`.")
-            sys.exit(1)
-        raise RuntimeError(f"Ollama error: {err.strip()}")
-    return out
+    try:
+        r = await _client.generate(
+            model=model,
+            prompt=prompt,
+            stream=False,
+            options=OLLAMA_OPTIONS,
+            keep_alive=OLLAMA_KEEP_ALIVE,
+        )
+    except ConnectionError:
+        # printed on exit, after main() has restored stdout/stderr
+        sys.exit("\n❗️ Could not connect to Ollama daemon. Run `ollama serve`.")
+    except ResponseError as e:
+        raise RuntimeError(f"Ollama error: {e.error}")
+    return r["response"].strip()
 
-async def fetch_markdown(url: str) -> str:
+def summary_key(prompt: str, model: str) -> str:
     """
-    1) Try dynamic scrape via Crawl4AI/Playwright, completely silencing its logs.
-    2) On any error, silently fall back to requests+html2text.
-    3) Only truly unhandled errors (like network down) will raise.
+    Short content hash of a model/prompt pair. BLAKE2b is faster than
+    SHA-256 and collision resistance is all we need here.
     """
-    browser_cfg = BrowserConfig(headless=True)
-    crawl_cfg   = CrawlerRunConfig(
-        page_timeout=30_000,
-        wait_for="css:body"
-    )
+    return hashlib.blake2b(
+        f"{model}\0{PROMPT_VERSION}\0{prompt}".encode("utf-8"),
+        digest_size=16
+    ).hexdigest()
 
-    # 1) Dynamic scrape (silent)
+def summary_cache_path(key: str) -> str:
+    """
+    Content-addressed cache file for a `summary_key`.
+    """
+    return os.path.join(CACHE_DIR, key[:2], f"{key}.txt")
+
+def read_cache(path: str) -> Optional[str]:
+    """
+    Return the summary cached at `path`, or None if there is none yet.
+    """
+    try:
+        with open(path, encoding="utf-8") as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+def write_cache(path: str, summary: str):
+    """
+    Store `summary` at `path` atomically (tmp file + os.replace).
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(summary)
+    os.replace(tmp, path)
+
+async def cached_summary(key: str, prompt: str, model: str) -> str:
+    """
+    Return the summary stored on disk for `prompt`, or generate it and
+    store it atomically (tmp file + os.replace) for later runs.
+    """
+    path = summary_cache_path(key)
+    # disk I/O runs off the event loop, so crawls keep moving; on a
+    # re-run every chunk is a cache hit
+    summary = await asyncio.to_thread(read_cache, path)
+    if summary is not None:
+        return summary
+
+    summary = await generate_summary(prompt, model)
+    await asyncio.to_thread(write_cache, path, summary)
+    return summary
+
+# summary_key -> shared Task, least recently used first
+_summary_tasks: OrderedDict[str, asyncio.Task] = OrderedDict()
+SUMMARY_MEMO_SIZE = 8192
+
+def summary_task(key: str, prompt: str, model: str) -> asyncio.Task:
+    """
+    In-process layer above the disk cache: one shared Task per distinct
+    prompt, so duplicate chunks in a run (even in flight) cost one call.
+    Looked up by the short digest alone and bounded to SUMMARY_MEMO_SIZE;
+    a Task that fails is dropped so the next duplicate retries.
+    """
+    task = _summary_tasks.get(key)
+    if task is not None:
+        _summary_tasks.move_to_end(key)
+        return task
+    task = asyncio.ensure_future(cached_summary(key, prompt, model))
+    _summary_tasks[key] = task
+
+    def forget_failed(t: asyncio.Task):
+        if (t.cancelled() or t.exception()) and _summary_tasks.get(key) is t:
+            del _summary_tasks[key]
+
+    task.add_done_callback(forget_failed)
+    if len(_summary_tasks) > SUMMARY_MEMO_SIZE:
+        _summary_tasks.popitem(last=False)
+    return task
+
+async def summarize_chunk(text: str, model: str) -> str:
+    """
+    Summarize *all* of `text` in 2–4 sentences, reusing any cached summary.
+    """
+    prompt = PROMPT_TMPL.format(text)
+    return await summary_task(summary_key(prompt, model), prompt, model)
+
+async def fetch_markdown(crawler: AsyncWebCrawler,
+                         http: aiohttp.ClientSession,
+                         url: str) -> tuple[str, str]:
+    """
+    Return (full page markdown, main content only); the first is saved,
+    the second is what gets summarized.
+    1) Try dynamic scrape via the shared Crawl4AI/Playwright crawler.
+    2) On any error, silently fall back to aiohttp+html2text.
+    3) Only truly unhandled errors (like network down) will raise.
+    """
+    # 1) Dynamic scrape (main() silences its logs for the whole run)
     try:
-        with open(os.devnull, "w") as devnull:
-            with contextlib.redirect_stdout(devnull), contextlib.redirect_stderr(devnull):
-                async with AsyncWebCrawler(config=browser_cfg) as crawler:
-                    res = await crawler.arun(url=url, config=crawl_cfg)
+        res = await crawler.arun(url=url, config=CRAWL_CFG)
         if res.success and res.markdown:
-            return res.markdown
+            # keep the full page as content if the filter pruned everything
+            return res.markdown, res.markdown.fit_markdown or res.markdown
     except Exception:
         # fully swallow any Crawl4AI/playwright errors
         pass
 
-    # 2) Static fallback
-    resp = requests.get(url, headers=REQUEST_HEADERS, timeout=10)
-    resp.raise_for_status()
-    html = resp.text
+    # 2) Static fallback over the shared connection pool
+    async with get_with_retry(http, url) as resp:
+        resp.raise_for_status()
+        html = await resp.text(errors="replace")
 
     conv = html2text.HTML2Text()
     conv.ignore_links = False
     conv.body_width   = 0
-    return conv.handle(html)
+    md = conv.handle(html)
+    # readability keeps only the main article; it may choke on odd pages
+    try:
+        content = conv.handle(Document(html).summary()).strip()
+    except Exception:
+        content = ""
+    return md, content or md
+
+def strip_boilerplate(md: str) -> str:
+    """
+    Drop leftover chrome lines so the prompt carries only content;
+    every input token costs inference time.
+    """
+    return BOILERPLATE_PAT.sub("", md)
 
 async def main():
     ensure_model(MODEL)
 
     # build list of pages
     if URL.lower().endswith(".xml") or "sitemap" in URL.lower():
-        targets = fetch_sitemap_urls(URL)
+        async with http_session() as session:
+            targets = await fetch_sitemap_urls(session, URL)
         print(f"🔍 Discovered {len(targets)} page URLs via sitemap recursion.")
     else:
         targets = [URL]
 
     os.makedirs(OUTPUT_DIR, exist_ok=True)
     count = 0
+    sem = asyncio.Semaphore(CRAWL_CONCURRENCY)
+    # our own progress output bypasses the crawl-time redirect below
+    console = sys.stdout
 
-    for target in targets:
-        print(f"\n▶️  Processing {target}")
-        try:
-            md = await fetch_markdown(target)
-        except Exception as e:
-            print(f"⚠️  Skipping {target} due to: {e}")
-            continue
+    async def worker(crawler: AsyncWebCrawler,
+                     http: aiohttp.ClientSession,
+                     target: str):
+        nonlocal count
+        async with sem:
+            print(f"\n▶️  Processing {target}", file=console)
+            try:
+                md, content = await fetch_markdown(crawler, http, target)
+            except Exception as e:
+                print(f"⚠️  Skipping {target} due to: {e}", file=console)
+                return
+
+            summary = await summarize_chunk(strip_boilerplate(content), MODEL)
 
-        summary = summarize_chunk(md, MODEL)
+            # derive a safe filename from the URL path
+            parsed = urlparse(target)
+            # strip trailing slash so basename() isn’t empty
+            clean_path = parsed.path.rstrip("/")  
+            base = os.path.basename(clean_path)
+            slug = base or "index"
+            filename = f"{slug}.md"
+            out_path = os.path.join(OUTPUT_DIR, filename)
 
-        # derive a safe filename from the URL path
-        parsed = urlparse(target)
-        # strip trailing slash so basename() isn’t empty
-        clean_path = parsed.path.rstrip("/")  
-        base = os.path.basename(clean_path)
-        slug = base or "index"
-        filename = f"{slug}.md"
-        out_path = os.path.join(OUTPUT_DIR, filename)
+            payload = b"".join(
+                [b"Summary:\n", summary.encode("utf-8"), b"\n\n", md.encode("utf-8")]
+            )
+            async with aiofiles.open(out_path, "wb") as f:
+                await f.write(payload)
 
-        with open(out_path, "w", encoding="utf-8") as f:
-            f.write("Summary:\n")
-            f.write(summary + "\n\n")
-            f.write(md)
+            count += 1
+            print(f"✅ Wrote {out_path}", file=console)
 
-        count += 1
-        print(f"✅ Wrote {out_path}")
+    # One browser for the whole run, silenced once: swapping sys.stdout
+    # per call is not safe with several crawls in flight. Fallback
+    # fetches share one pooled aiohttp session alongside it.
+    with open(os.devnull, "w") as devnull:
+        with contextlib.redirect_stdout(devnull), contextlib.redirect_stderr(devnull):
+            async with AsyncWebCrawler(config=BROWSER_CFG) as crawler, \
+                       http_session() as http:
+                results = await asyncio.gather(
+                    *[worker(crawler, http, t) for t in targets],
+                    return_exceptions=True
+                )
+    for target, res in zip(targets, results):
+        if isinstance(res, Exception):
+            print(f"⚠️  Failed {target}: {res}")
 
     print(f"\n🎉 Completed. Wrote {count} files into {OUTPUT_DIR}")
 